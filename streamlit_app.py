@@ -1,16 +1,23 @@
 import os
+import re
+import functools
+import logging
+import threading
+import time
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
-from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from urllib.parse import urlparse
 
 import numpy as np
 import pandas as pd
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from google.oauth2 import service_account
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import (
-    RunReportRequest, Dimension, Metric, Filter, FilterExpression,
-    FilterExpressionList, OrderBy
+    RunReportRequest, BatchRunReportsRequest, Dimension, Metric, Filter,
+    FilterExpression, FilterExpressionList, OrderBy
 )
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -44,6 +51,8 @@ div[data-testid="stExpander"] {
 </style>
 """, unsafe_allow_html=True)
 
+log = logging.getLogger(__name__)
+
 DASH_LOGO = st.secrets.get("DASH_LOGO", os.getenv("DASH_LOGO", "assets/logo.svg"))
 SIDEBAR_LOGO = st.secrets.get("SIDEBAR_LOGO", os.getenv("SIDEBAR_LOGO", "assets/internews.svg"))
 
@@ -85,20 +94,14 @@ def render_logo(path: str, width: int | None = None):
         st.image(str(p), use_column_width=(width is None), width=width)
 
 INVISIBLE = ("\ufeff", "\u200b", "\u2060", "\u00a0")
+INVISIBLE_RE = re.compile("[" + "".join(INVISIBLE) + "]")
 
-def clean_line(s: str) -> str:
-    if s is None:
-        return ""
-    if not isinstance(s, str):
-        s = str(s)
-    for ch in INVISIBLE:
-        s = s.replace(ch, "")
-    return s.strip()
-
-def strip_utm_and_fragment(raw_url: str) -> str:
-    p = urlparse(raw_url)
-    q = [(k, v) for k, v in parse_qsl(p.query, keep_blank_values=True) if not k.lower().startswith("utm_")]
-    return urlunparse((p.scheme, p.netloc, p.path, p.params, urlencode(q, doseq=True), ""))
+def clean_lines(raw_list: list) -> list[str]:
+    # strip invisible chars and whitespace over a whole paste/upload in one vectorized pass
+    if not raw_list:
+        return []
+    s = pd.Series(raw_list, dtype=object).fillna("").astype(str)
+    return s.str.replace(INVISIBLE_RE, "", regex=True).str.strip().tolist()
 
 def looks_like_domain_no_scheme(s: str) -> bool:
     s = s.strip()
@@ -116,10 +119,11 @@ def normalize_any_input_to_path_and_host(raw: str) -> tuple[str, str | None]:
       - domain/path...
       - /path...
       - path...
+    raw is a line already cleaned by clean_lines.
     Returns:
       path (always starting with "/"), host (if detected)
     """
-    s = clean_line(raw)
+    s = raw
     if not s:
         return "", None
 
@@ -128,8 +132,8 @@ def normalize_any_input_to_path_and_host(raw: str) -> tuple[str, str | None]:
         s = "https://" + s
 
     if s.lower().startswith(("http://", "https://")):
-        s2 = strip_utm_and_fragment(s)
-        p = urlparse(s2)
+        # query (incl. utm_*) and fragment never reach the path/host
+        p = urlparse(s)
         path = p.path or "/"
         if not path.startswith("/"):
             path = "/" + path
@@ -142,6 +146,7 @@ def normalize_any_input_to_path_and_host(raw: str) -> tuple[str, str | None]:
     return s, None
 
 def collect_paths_hosts(raw_list: list[str]) -> tuple[list[str], list[str], list[str]]:
+    # raw_list is the output of clean_lines()
     seen = set()
     unique_paths = []
     hosts = set()
@@ -163,12 +168,16 @@ def read_uploaded_lines(uploaded) -> list[str]:
         return []
     try:
         if uploaded.name.lower().endswith(".txt"):
-            return [clean_line(b.decode("utf-8", errors="ignore")) for b in uploaded.readlines()]
+            return clean_lines([b.decode("utf-8", errors="ignore") for b in uploaded.readlines()])
         dfu = pd.read_csv(uploaded, header=None)
-        return [clean_line(x) for x in dfu.iloc[:, 0].tolist()]
+        return clean_lines(dfu.iloc[:, 0].tolist())
     except Exception:
         return []
 
+@st.cache_data(ttl=300, max_entries=50, show_spinner=False)
+def df_to_csv_bytes(df: pd.DataFrame) -> bytes:
+    return df.to_csv(index=False).encode("utf-8")
+
 # ──────────────────────────────────────────────────────────────────────────────
 # GA4 client
 # ──────────────────────────────────────────────────────────────────────────────
@@ -191,47 +200,177 @@ def default_property_id() -> str:
 # ──────────────────────────────────────────────────────────────────────────────
 # GA4 queries
 # ──────────────────────────────────────────────────────────────────────────────
+# tabs 1 and 2 read the same page-level report shape: DIMS_PAGE x METRICS_PAGE
+DIMS_PAGE = ["pagePath", "pageTitle"]
 METRICS_PAGE = ["screenPageViews", "activeUsers", "userEngagementDuration"]
+PAGE_ROWS = 10000     # rows per page of a paged report
+PAGE_WORKERS = 4      # parallel run_report calls for the pages after the first
+PAGED_MAX_ROWS = 100000  # rows fetched per paged report at most (e.g. "/" matches every page)
 
 def make_path_filter(paths_batch: list[str]) -> FilterExpression:
-    exprs = [
-        FilterExpression(
-            filter=Filter(
-                field_name="pagePath",
-                string_filter=Filter.StringFilter(
-                    value=pth,
-                    match_type=Filter.StringFilter.MatchType.BEGINS_WITH,
-                    case_sensitive=False,
-                )
+    # one FULL_REGEXP predicate instead of an or_group of per-path filters;
+    # exact, case-sensitive match: results are joined back on the exact pagePath,
+    # so rows under a pasted path (e.g. everything under "/") would only be discarded
+    pattern = "^(?:" + "|".join(re.escape(pth) for pth in paths_batch) + ")$"
+    return FilterExpression(
+        filter=Filter(
+            field_name="pagePath",
+            string_filter=Filter.StringFilter(
+                value=pattern,
+                match_type=Filter.StringFilter.MatchType.FULL_REGEXP,
+                case_sensitive=True,
             )
         )
-        for pth in paths_batch
-    ]
-    return FilterExpression(or_group=FilterExpressionList(expressions=exprs))
+    )
+
+def pb_rows(resp):
+    # raw protobuf rows: skips proto-plus wrapping on every field access
+    return type(resp).pb(resp).rows
+
+def to_int_array(raw: list[str]) -> np.ndarray:
+    return pd.to_numeric(pd.Series(raw, dtype=object), errors="coerce").fillna(0).to_numpy(dtype=np.int64)
+
+def to_float_array(raw: list[str]) -> np.ndarray:
+    return pd.to_numeric(pd.Series(raw, dtype=object), errors="coerce").fillna(0).to_numpy(dtype=np.float64)
+
+# explicit pyarrow dtypes per report column: convert_dtypes() would infer them from
+# the data (e.g. a float column with only whole values would become int64)
+A_STR, A_INT, A_FLOAT = "string[pyarrow]", "int64[pyarrow]", "double[pyarrow]"
+
+PATHS_DTYPES = {
+    "pagePath": A_STR, "pageTitle": A_STR, "hostName": A_STR,
+    "screenPageViews": A_INT, "activeUsers": A_INT, "userEngagementDuration": A_FLOAT,
+    "viewsPerActiveUser": A_FLOAT, "avgEngagementTime_sec": A_FLOAT,
+}
+TOP_DTYPES = {"Path": A_STR, "Title": A_STR, "Views": A_INT, "Unique Users": A_INT, "Avg Engagement Time (s)": A_FLOAT}
+TOTALS_DTYPES = {"sessions": A_INT, "totalUsers": A_INT, "screenPageViews": A_INT}
+DEMO_DTYPES = {"Gender": "category", "Users": A_INT, "Views": A_INT, "Avg Engagement Time (s)": A_FLOAT}
+
+def with_dtypes(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    return df.astype({c: t for c, t in dtypes.items() if c in df.columns})
 
 def _empty_paths_df(with_host: bool) -> pd.DataFrame:
     cols = ["pagePath", "pageTitle"] + (["hostName"] if with_host else []) + METRICS_PAGE
     return pd.DataFrame(columns=cols)
 
-def fetch_ga4_by_paths(property_id: str, paths_in: list[str], hosts_in: list[str],
-                       start_date: str, end_date: str, order_keys: list[str]) -> pd.DataFrame:
-    if not property_id:
-        property_id = default_property_id()
+GA4_FINAL_AFTER_DAYS = 3  # GA4 may still reprocess the last ~48h of data
+PERSISTED_MAX_ENTRIES = 300  # in-memory side of the persisted caches
+PERSISTED_MAX_FILES = 300    # .memo pickles kept on disk (newest first)
+PERSISTED_MAX_AGE_DAYS = 14
+# Streamlit keys cached functions on their own source only, so changes to the
+# request builders / parsers they call never invalidate persisted pickles:
+# bump this whenever a report's request or output shape changes
+REPORT_CACHE_VERSION = 3
 
-    want_host = bool(hosts_in)
+def is_final_period(end_date: str) -> bool:
+    try:
+        return date.fromisoformat(end_date) <= date.today() - timedelta(days=GA4_FINAL_AFTER_DAYS)
+    except ValueError:  # relative dates like "today" / "30daysAgo"
+        return False
 
-    if not paths_in:
-        return _empty_paths_df(want_host)
+@st.cache_resource(ttl=3600, show_spinner=False)
+def prune_persisted_reports() -> int:
+    """
+    Streamlit never deletes persisted cache files (max_entries only evicts from memory,
+    evicted keys are re-read from disk), so drop old and surplus .memo files ourselves,
+    at most once an hour. The report caches are this app's only persisted caches.
+    """
+    from streamlit.file_util import get_streamlit_file_path
 
-    client = ga_client()
-    rows, BATCH = [], 25
+    files = sorted(Path(get_streamlit_file_path("cache")).glob("*.memo"),
+                   key=lambda f: f.stat().st_mtime, reverse=True)
+    cutoff = time.time() - PERSISTED_MAX_AGE_DAYS * 86400
+    removed = 0
+    for i, f in enumerate(files):
+        try:
+            if i >= PERSISTED_MAX_FILES or f.stat().st_mtime < cutoff:
+                f.unlink()
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+@st.cache_resource
+def report_cache_stats() -> tuple[threading.Lock, dict]:
+    # shared by all sessions; filled by ga4_cache
+    return threading.Lock(), {}
+
+# set by handoff_take while a miss is served from another entry's batch call
+_served_by_handoff = threading.local()
+
+def _bump_stat(name: str, field: str, amount: float = 1):
+    lock, stats = report_cache_stats()
+    with lock:
+        rec = stats.setdefault(name, {"calls": 0, "misses": 0, "seconds": 0.0})
+        rec[field] += amount
+
+def ga4_cache(fn):
+    """
+    st.cache_data for report functions taking (property_id, start_date, end_date, ...).
+    Periods that GA4 has finished processing are cached on disk and survive restarts
+    (Streamlit ignores ttl for persisted caches, so prune_persisted_reports bounds
+    them on disk); recent periods keep the 5-minute ttl.
+    Calls, misses and time spent on misses are counted for the sidebar cache panel.
+    Misses filled through report_handoff are counted as hits.
+    """
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def timed(*args, **kwargs):
+        # only runs on a cache miss; a fill from a handoff made no GA4 call of its
+        # own (its time is in the entry that ran the batch), so it counts as a hit
+        _served_by_handoff.flag = False
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if not _served_by_handoff.flag:
+                _bump_stat(name, "misses")
+                _bump_stat(name, "seconds", time.perf_counter() - t0)
+
+    live = st.cache_data(ttl=300, show_spinner=False)(timed)
+
+    @functools.wraps(fn)
+    def final(*args, **kwargs):
+        return timed(*args, **kwargs)
+    # own cache, separate from `live`; the version salt retires pickles of older shapes
+    final.__qualname__ += f".persisted.v{REPORT_CACHE_VERSION}"
+    persisted = st.cache_data(persist="disk", max_entries=PERSISTED_MAX_ENTRIES, show_spinner=False)(final)
+
+    @functools.wraps(fn)
+    def dispatch(property_id, start_date, end_date, *args, **kwargs):
+        _bump_stat(name, "calls")
+        if is_final_period(end_date):
+            prune_persisted_reports()
+            cached = persisted
+        else:
+            cached = live
+        return cached(property_id, start_date, end_date, *args, **kwargs)
+    return dispatch
+
+def report_cache_stats_df() -> pd.DataFrame:
+    lock, stats = report_cache_stats()
+    with lock:
+        recs = [(name, dict(rec)) for name, rec in sorted(stats.items())]
+    return pd.DataFrame([{
+        "Функция": name,
+        "Вызовы": rec["calls"],
+        "Попадания": rec["calls"] - rec["misses"],
+        "Промахи": rec["misses"],
+        "Среднее время запроса (с)": round(rec["seconds"] / max(rec["misses"], 1), 2),
+    } for name, rec in recs])
+
+def paths_report_requests(property_id: str, paths_in: list[str], hosts_in: list[str],
+                          start_date: str, end_date: str) -> list[RunReportRequest]:
+    want_host = bool(hosts_in)
+    reqs, BATCH = [], 25
 
     for i in range(0, len(paths_in), BATCH):
         batch = paths_in[i:i+BATCH]
         base = make_path_filter(batch)
         dim_filter = base
 
-        dims = [Dimension(name="pagePath"), Dimension(name="pageTitle")]
+        dim_names = list(DIMS_PAGE)
 
         if want_host:
             host_expr = FilterExpression(
@@ -241,30 +380,45 @@ def fetch_ga4_by_paths(property_id: str, paths_in: list[str], hosts_in: list[str
                 )
             )
             dim_filter = FilterExpression(and_group=FilterExpressionList(expressions=[base, host_expr]))
-            dims.append(Dimension(name="hostName"))
+            dim_names.append("hostName")
 
-        req = RunReportRequest(
+        reqs.append(RunReportRequest(
             property=f"properties/{property_id}",
-            dimensions=dims,
+            dimensions=[Dimension(name=d) for d in dim_names],
             metrics=[Metric(name=m) for m in METRICS_PAGE],
             date_ranges=[{"start_date": start_date, "end_date": end_date}],
             dimension_filter=dim_filter,
-            limit=100000,
-        )
+            # pages are separate calls: a fixed row order keeps a row from landing on two of them
+            order_bys=[OrderBy(dimension=OrderBy.DimensionOrderBy(dimension_name=d)) for d in dim_names],
+            limit=PAGE_ROWS,
+            keep_empty_rows=False,
+        ))
+    return reqs
+
+def paths_report_df(responses: list, paths_in: list[str], hosts_in: list[str]) -> pd.DataFrame:
+    want_host = bool(hosts_in)
 
-        resp = client.run_report(req)
-        for r in resp.rows:
-            rec = {}
-            idx = 0
-            rec["pagePath"] = r.dimension_values[idx].value; idx += 1
-            rec["pageTitle"] = r.dimension_values[idx].value; idx += 1
+    if not paths_in:
+        return with_dtypes(_empty_paths_df(want_host), PATHS_DTYPES)
+
+    cols = {"pagePath": [], "pageTitle": []}
+    if want_host:
+        cols["hostName"] = []
+    for m in METRICS_PAGE:
+        cols[m] = []
+
+    metric_cols = [cols[m] for m in METRICS_PAGE]
+    for resp in responses:
+        for r in pb_rows(resp):
+            dv = r.dimension_values
+            cols["pagePath"].append(dv[0].value)
+            cols["pageTitle"].append(dv[1].value)
             if want_host:
-                rec["hostName"] = r.dimension_values[idx].value
-            for j, m in enumerate(METRICS_PAGE):
-                rec[m] = r.metric_values[j].value
-            rows.append(rec)
+                cols["hostName"].append(dv[2].value)
+            for col, mv in zip(metric_cols, r.metric_values):
+                col.append(mv.value)
 
-    df = pd.DataFrame(rows)
+    df = pd.DataFrame(cols)
 
     # FIX: if GA4 returned no rows — create empty DF with expected columns
     if df.empty:
@@ -312,9 +466,6 @@ def fetch_ga4_by_paths(property_id: str, paths_in: list[str], hosts_in: list[str
             zeros["hostName"] = hosts_in[0] if hosts_in else ""
         df = pd.concat([df, zeros], ignore_index=True)
 
-    # preserve original order (including duplicates)
-    df = df.set_index("pagePath").reindex(order_keys).reset_index()
-
     # derived metrics
     if "activeUsers" not in df.columns:
         df["activeUsers"] = 0
@@ -323,63 +474,209 @@ def fetch_ga4_by_paths(property_id: str, paths_in: list[str], hosts_in: list[str
     if "userEngagementDuration" not in df.columns:
         df["userEngagementDuration"] = 0
 
-    den = pd.to_numeric(df["activeUsers"], errors="coerce").replace(0, np.nan).astype(float)
-    df["viewsPerActiveUser"] = (pd.to_numeric(df["screenPageViews"], errors="coerce").astype(float) / den).fillna(0).round(2)
-    df["avgEngagementTime_sec"] = (pd.to_numeric(df["userEngagementDuration"], errors="coerce").astype(float) / den).fillna(0).round(1)
+    # rows without active users get 0, not views / 1
+    users = pd.to_numeric(df["activeUsers"], errors="coerce").fillna(0).to_numpy(dtype=np.float64)
+    views = pd.to_numeric(df["screenPageViews"], errors="coerce").fillna(0).to_numpy(dtype=np.float64)
+    eng = pd.to_numeric(df["userEngagementDuration"], errors="coerce").fillna(0).to_numpy(dtype=np.float64)
+    has_users = users > 0
+    df["viewsPerActiveUser"] = np.round(np.divide(views, users, out=np.zeros_like(users), where=has_users), 2)
+    df["avgEngagementTime_sec"] = np.round(np.divide(eng, users, out=np.zeros_like(users), where=has_users), 1)
 
-    return df
+    return with_dtypes(df, PATHS_DTYPES)
 
-@st.cache_data(ttl=300, show_spinner=False)
-def fetch_by_paths_cached(property_id: str, paths: tuple, hosts: tuple, start_date: str, end_date: str, order_keys: tuple) -> pd.DataFrame:
-    return fetch_ga4_by_paths(property_id, list(paths), list(hosts), start_date, end_date, list(order_keys))
+def order_paths_df(df: pd.DataFrame, order_keys: list[str]) -> pd.DataFrame:
+    # preserve original order (including duplicates); the index round trip turns
+    # pagePath back into object dtype, so the pinned dtypes are re-applied
+    return with_dtypes(df.set_index("pagePath").reindex(order_keys).reset_index(), PATHS_DTYPES)
 
-@st.cache_data(ttl=300, show_spinner=False)
-def fetch_top_materials_cached(property_id: str, start_date: str, end_date: str, limit: int) -> pd.DataFrame:
-    client = ga_client()
-    req = RunReportRequest(
+def top_materials_request(property_id: str, start_date: str, end_date: str, limit: int) -> RunReportRequest:
+    return RunReportRequest(
         property=f"properties/{property_id}",
-        dimensions=[Dimension(name="pagePath"), Dimension(name="pageTitle")],
-        metrics=[Metric(name="screenPageViews"), Metric(name="activeUsers"), Metric(name="userEngagementDuration")],
+        dimensions=[Dimension(name=d) for d in DIMS_PAGE],
+        metrics=[Metric(name=m) for m in METRICS_PAGE],
         date_ranges=[{"start_date": start_date, "end_date": end_date}],
         order_bys=[OrderBy(metric=OrderBy.MetricOrderBy(metric_name="screenPageViews"), desc=True)],
         limit=int(limit),
+        keep_empty_rows=False,
     )
-    resp = client.run_report(req)
-    rows = []
-    for r in resp.rows:
-        views = int(float(r.metric_values[0].value or 0))
-        users = int(float(r.metric_values[1].value or 0))
-        eng = float(r.metric_values[2].value or 0)
-        rows.append({
-            "Path": r.dimension_values[0].value,
-            "Title": r.dimension_values[1].value,
-            "Views": views,
-            "Unique Users": users,
-            "Avg Engagement Time (s)": round(eng / max(users, 1), 1),
-        })
-    return pd.DataFrame(rows)
 
-@st.cache_data(ttl=300, show_spinner=False)
-def fetch_site_totals_cached(property_id: str, start_date: str, end_date: str) -> pd.DataFrame:
-    client = ga_client()
-    req = RunReportRequest(
+def top_materials_df(resp) -> pd.DataFrame:
+    rows = pb_rows(resp)
+    n = len(rows)
+    paths = np.empty(n, dtype=object)
+    titles = np.empty(n, dtype=object)
+    v_raw, u_raw, e_raw = [], [], []
+    for i, r in enumerate(rows):
+        dv, mv = r.dimension_values, r.metric_values
+        paths[i] = dv[0].value
+        titles[i] = dv[1].value
+        v_raw.append(mv[0].value)
+        u_raw.append(mv[1].value)
+        e_raw.append(mv[2].value)
+    views, users, eng = to_int_array(v_raw), to_int_array(u_raw), to_float_array(e_raw)
+    return pd.DataFrame({
+        "Path": paths,
+        "Title": titles,
+        "Views": views,
+        "Unique Users": users,
+        "Avg Engagement Time (s)": np.round(eng / np.maximum(users, 1), 1),
+    }).astype(TOP_DTYPES)
+
+def site_totals_request(property_id: str, start_date: str, end_date: str) -> RunReportRequest:
+    return RunReportRequest(
         property=f"properties/{property_id}",
         metrics=[Metric(name="sessions"), Metric(name="totalUsers"), Metric(name="screenPageViews")],
         date_ranges=[{"start_date": start_date, "end_date": end_date}],
         limit=1,
+        keep_empty_rows=False,
+        return_property_quota=False,
     )
-    resp = client.run_report(req)
+
+def site_totals_df(resp) -> pd.DataFrame:
     row = resp.rows[0].metric_values if resp.rows else []
     return pd.DataFrame([{
         "sessions": int(row[0].value) if row else 0,
         "totalUsers": int(row[1].value) if row else 0,
         "screenPageViews": int(row[2].value) if row else 0,
-    }])
+    }]).astype(TOTALS_DTYPES)
+
+TOP_LIMIT_DEFAULT = 10
+
+BATCH_REPORTS_MAX = 5  # GA4 batchRunReports accepts at most 5 requests
+
+def run_reports(property_id: str, reqs: list[RunReportRequest]) -> list:
+    if not reqs:
+        return []
+    client = ga_client()
+    batches = [
+        BatchRunReportsRequest(property=f"properties/{property_id}", requests=reqs[i:i+BATCH_REPORTS_MAX])
+        for i in range(0, len(reqs), BATCH_REPORTS_MAX)
+    ]
+    if len(batches) == 1:
+        return list(client.batch_run_reports(batches[0]).reports)
+    # overlap the round trips; map() keeps responses in request order
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as ex:
+        return [rep for resp in ex.map(client.batch_run_reports, batches) for rep in resp.reports]
+
+def fetch_remaining_pages(reqs: list[RunReportRequest], responses: list) -> list:
+    # the first page already carries row_count; fetch every later page in parallel
+    page_reqs = [
+        RunReportRequest(req, offset=offset)
+        for req, resp in zip(reqs, responses)
+        for offset in range(req.limit, min(resp.row_count, PAGED_MAX_ROWS), req.limit)
+    ]
+    if not page_reqs:
+        return []
+    client = ga_client()
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as ex:
+        return list(ex.map(client.run_report, page_reqs))
+
+@ga4_cache
+def fetch_by_paths_cached(property_id: str, start_date: str, end_date: str, paths: tuple, hosts: tuple) -> pd.DataFrame:
+    # expects paths/hosts canonicalized by fetch_by_paths()
+    if not property_id:
+        property_id = default_property_id()
+
+    paths_in, hosts_in = list(paths), list(hosts)
+    reqs = paths_report_requests(property_id, paths_in, hosts_in, start_date, end_date)
+    reports = run_reports(property_id, reqs)
+    reports += fetch_remaining_pages(reqs, reports)
+    return paths_report_df(reports, paths_in, hosts_in)
+
+def fetch_by_paths(property_id: str, start_date: str, end_date: str, paths: list[str], hosts: list[str],
+                   order_keys: list[str]) -> pd.DataFrame:
+    # sorted unique paths/hosts make permutations of the same input one cache entry;
+    # the caller's order is applied after the cache
+    df = fetch_by_paths_cached(
+        property_id, start_date, end_date, tuple(sorted(set(paths))), tuple(sorted(set(hosts))),
+    )
+    return order_paths_df(df, list(order_keys))
+
+HANDOFF_TTL = 300  # same as the live report cache
+
+@st.cache_resource
+def report_handoff() -> tuple[threading.Lock, dict]:
+    # responses fetched in another entry's batch call, keyed on the full arguments
+    # of the cache entry they belong to
+    return threading.Lock(), {}
+
+def handoff_put(key: tuple, resp):
+    lock, store = report_handoff()
+    now = time.time()
+    with lock:
+        for k in [k for k, (t, _) in store.items() if now - t > HANDOFF_TTL]:
+            del store[k]
+        store[key] = (now, resp)
+
+def handoff_take(key: tuple):
+    lock, store = report_handoff()
+    with lock:
+        t, resp = store.pop(key, (0.0, None))
+    if time.time() - t > HANDOFF_TTL:
+        return None
+    _served_by_handoff.flag = True
+    return resp
+
+@ga4_cache
+def fetch_top_materials_cached(property_id: str, start_date: str, end_date: str, limit: int) -> pd.DataFrame:
+    # a cold top-N entry brings the site totals along in the same batchRunReports call
+    # and hands them to fetch_site_totals_cached
+    top_resp, totals_resp = run_reports(property_id, [
+        top_materials_request(property_id, start_date, end_date, limit),
+        site_totals_request(property_id, start_date, end_date),
+    ])
+    handoff_put(("totals", property_id, start_date, end_date), totals_resp)
+    return top_materials_df(top_resp)
+
+@ga4_cache
+def fetch_site_totals_cached(property_id: str, start_date: str, end_date: str) -> pd.DataFrame:
+    resp = handoff_take(("totals", property_id, start_date, end_date))
+    if resp is None:
+        resp = ga_client().run_report(site_totals_request(property_id, start_date, end_date))
+    return site_totals_df(resp)
+
+def fetch_top_and_totals(property_id: str, start_date: str, end_date: str,
+                         limit: int) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Top materials and site totals, each from its own cache entry.
+    When both are cold, a single batchRunReports call fills both; when only the
+    totals are cold, they cost one single-report call.
+    Returns:
+      (top materials df, site totals df)
+    """
+    df_top = fetch_top_materials_cached(property_id, start_date, end_date, limit)
+    return df_top, fetch_site_totals_cached(property_id, start_date, end_date)
+
+DEFAULT_WINDOW_DAYS = 30
+
+PREWARM_EVERY = 300  # the live cache's ttl: the current day's entries expire that often
+
+@st.cache_resource(show_spinner=False, ttl=2 * PREWARM_EVERY, max_entries=20)
+def prewarm_default_window(property_id: str, today_iso: str, bucket: int) -> threading.Thread:
+    """
+    Fill the report cache for the sidebar's default period in the background,
+    once per property and PREWARM_EVERY seconds (bucket is part of the key, so the
+    prewarm re-fires as soon as the entries it filled have expired).
+    """
+    ga_client()  # build the client here, so failures surface in the UI, not in the thread
+    today = date.fromisoformat(today_iso)
+    start_date, end_date = (today - timedelta(days=DEFAULT_WINDOW_DAYS)).isoformat(), today_iso
+
+    def warm():
+        try:
+            fetch_top_and_totals(property_id, start_date, end_date, TOP_LIMIT_DEFAULT)
+        except Exception:
+            log.exception("Cache prewarm failed for property %s (%s..%s)", property_id, start_date, end_date)
+
+    t = threading.Thread(target=warm, daemon=True)
+    add_script_run_ctx(t, get_script_run_ctx())  # st.cache_* calls need a script context
+    t.start()
+    return t
 
 # ──────────────────────────────────────────────────────────────────────────────
 # NEW — Demographics (Gender)
 # ──────────────────────────────────────────────────────────────────────────────
-@st.cache_data(ttl=300, show_spinner=False)
+@ga4_cache
 def fetch_demographics_gender_cached(property_id: str, start_date: str, end_date: str) -> pd.DataFrame:
     client = ga_client()
     req = RunReportRequest(
@@ -392,25 +689,30 @@ def fetch_demographics_gender_cached(property_id: str, start_date: str, end_date
         ],
         date_ranges=[{"start_date": start_date, "end_date": end_date}],
         limit=100000,
+        keep_empty_rows=False,
     )
     resp = client.run_report(req)
 
-    rows = []
-    for r in resp.rows:
-        gender = (r.dimension_values[0].value or "unknown").lower()
-        users = int(float(r.metric_values[0].value or 0))
-        views = int(float(r.metric_values[1].value or 0))
-        eng = float(r.metric_values[2].value or 0)
-        rows.append({
-            "Gender": gender,
-            "Users": users,
-            "Views": views,
-            "Avg Engagement Time (s)": round(eng / max(users, 1), 1),
-        })
-
-    df = pd.DataFrame(rows)
+    rows = pb_rows(resp)
+    n = len(rows)
+    genders = np.empty(n, dtype=object)
+    u_raw, v_raw, e_raw = [], [], []
+    for i, r in enumerate(rows):
+        dv, mv = r.dimension_values, r.metric_values
+        genders[i] = (dv[0].value or "unknown").lower()
+        u_raw.append(mv[0].value)
+        v_raw.append(mv[1].value)
+        e_raw.append(mv[2].value)
+    users, views, eng = to_int_array(u_raw), to_int_array(v_raw), to_float_array(e_raw)
+
+    df = pd.DataFrame({
+        "Gender": genders,
+        "Users": users,
+        "Views": views,
+        "Avg Engagement Time (s)": np.round(eng / np.maximum(users, 1), 1),
+    })
     if df.empty:
-        return pd.DataFrame(columns=["Gender", "Users", "Views", "Avg Engagement Time (s)"])
+        return pd.DataFrame(columns=list(DEMO_DTYPES)).astype(DEMO_DTYPES)
 
     gender_map = {
         "male": "муж.",
@@ -424,6 +726,7 @@ def fetch_demographics_gender_cached(property_id: str, start_date: str, end_date
     df["Gender"] = df["Gender"].map(gender_map).fillna(df["Gender"])
 
     df = df.sort_values(["_ord", "Gender"]).drop(columns=["_ord"]).reset_index(drop=True)
+    df = df.astype(DEMO_DTYPES)
     return df
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -446,13 +749,20 @@ st.divider()
 with st.sidebar:
     st.markdown("### Отчётный период")
     today = date.today()
-    date_from = st.date_input("Дата начала", value=today - timedelta(days=30))
+    date_from = st.date_input("Дата начала", value=today - timedelta(days=DEFAULT_WINDOW_DAYS))
     date_to = st.date_input("Дата окончания", value=today)
 
     st.divider()
     pid_default = default_property_id()
     property_id = st.text_input("GA4 Property ID", value=pid_default)
 
+    with st.expander("Кэш отчётов"):
+        df_stats = report_cache_stats_df()
+        if df_stats.empty:
+            st.caption("Запросов к GA4 ещё не было.")
+        else:
+            st.dataframe(df_stats, use_container_width=True, hide_index=True)
+
     st.divider()
     st.markdown("### Developed by")
     st.markdown("**Alexey Terekhov**")
@@ -461,6 +771,13 @@ with st.sidebar:
         st.markdown("<br>", unsafe_allow_html=True)
         render_logo(SIDEBAR_LOGO, width=160)
 
+prewarm_default_window(pid_default, today.isoformat(), int(time.time() // PREWARM_EVERY))
+
+if date_from > date_to:
+    fail_ui("Date From must be <= Date To.")
+# ISO strings once: these are the cache-key surface of every report call
+start_iso, end_iso = date_from.isoformat(), date_to.isoformat()
+
 tab1, tab2, tab3, tab4 = st.tabs(["Статистика по загруженным ссылкам", "Лучшие материалы", "Общие показатели", "Демография"])
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -483,7 +800,7 @@ with tab1:
 
     lines = []
     if uinput:
-        lines.extend([clean_line(x) for x in uinput.splitlines() if clean_line(x)])
+        lines.extend([x for x in clean_lines(uinput.splitlines()) if x])
     lines.extend([x for x in read_uploaded_lines(uploaded) if x])
 
     url_like = sum(1 for x in lines if looks_like_domain_no_scheme(x) or x.lower().startswith(("http://", "https://")))
@@ -494,8 +811,6 @@ with tab1:
     st.caption(f"Lines: {len(lines)} | URLs: {url_like} | Paths: {path_like}{host_txt}")
 
     if st.button("Собрать данные"):
-        if date_from > date_to:
-            fail_ui("Date From must be <= Date To.")
         pid = property_id.strip()
         if not pid:
             fail_ui("GA4 Property ID is empty.")
@@ -503,13 +818,13 @@ with tab1:
             fail_ui("Пожалуйста, добавьте хотя бы один URL")
 
         with st.spinner("Fetching GA4 (pagePath)..."):
-            df_p = fetch_by_paths_cached(
+            df_p = fetch_by_paths(
                 pid,
-                tuple(unique_paths),
-                tuple(hostnames),
-                str(date_from),
-                str(date_to),
-                tuple(order_paths),
+                start_iso,
+                end_iso,
+                unique_paths,
+                hostnames,
+                order_paths,
             )
 
         # always show something (including zeros for missing)
@@ -544,7 +859,7 @@ with tab1:
 
         st.download_button(
             "Скачать CSV",
-            show.to_csv(index=False).encode("utf-8"),
+            df_to_csv_bytes(show),
             "ga4_url_analytics.csv",
             "text/csv",
         )
@@ -556,17 +871,15 @@ with tab2:
     st.subheader("Лидеры по показателям")
     c1, c2 = st.columns([1, 2])
     with c1:
-        limit = st.number_input("Количество", min_value=1, max_value=500, value=10)
+        limit = st.number_input("Количество", min_value=1, max_value=500, value=TOP_LIMIT_DEFAULT)
 
     if st.button("Сформировать рейтинг"):
-        if date_from > date_to:
-            fail_ui("Date From must be <= Date To.")
         pid = property_id.strip()
         if not pid:
             fail_ui("GA4 Property ID is empty.")
 
         with st.spinner(f"Extracting top {int(limit)} materials..."):
-            df_top = fetch_top_materials_cached(pid, str(date_from), str(date_to), int(limit))
+            df_top, _ = fetch_top_and_totals(pid, start_iso, end_iso, int(limit))
 
         if df_top.empty:
             st.info("No data returned for this period.")
@@ -574,7 +887,7 @@ with tab2:
             st.dataframe(df_top, use_container_width=True, hide_index=True)
             st.download_button(
                 "Скачать рейтинг (CSV)",
-                df_top.to_csv(index=False).encode("utf-8"),
+                df_to_csv_bytes(df_top),
                 "ga4_top.csv",
                 "text/csv",
             )
@@ -586,14 +899,14 @@ with tab3:
     st.subheader("Общая статистика сайта")
 
     if st.button("Показать данные"):
-        if date_from > date_to:
-            fail_ui("Date From must be <= Date To.")
         pid = property_id.strip()
         if not pid:
             fail_ui("GA4 Property ID is empty.")
 
         with st.spinner("Aggregating..."):
-            totals = fetch_site_totals_cached(pid, str(date_from), str(date_to))
+            # `limit` is tab 2's widget, already rendered: a cold top-N entry and the
+            # totals then share one batch call, whichever tab is clicked first
+            _, totals = fetch_top_and_totals(pid, start_iso, end_iso, int(limit))
             s = int(totals.loc[0, "sessions"])
             u = int(totals.loc[0, "totalUsers"])
             v = int(totals.loc[0, "screenPageViews"])
@@ -611,14 +924,12 @@ with tab4:
     st.markdown("Распределение аудитории по гендерному признаку.")
 
     if st.button("Показать демографию"):
-        if date_from > date_to:
-            fail_ui("Date From must be <= Date To.")
         pid = property_id.strip()
         if not pid:
             fail_ui("GA4 Property ID is empty.")
 
         with st.spinner("Fetching demographics..."):
-            df_demo = fetch_demographics_gender_cached(pid, str(date_from), str(date_to))
+            df_demo = fetch_demographics_gender_cached(pid, start_iso, end_iso)
 
         if df_demo.empty:
             st.info("No demographic data returned for this period.")
@@ -634,7 +945,7 @@ with tab4:
 
             st.download_button(
                 "Экспорт демографических данных (CSV)",
-                df_demo.to_csv(index=False).encode("utf-8"),
+                df_to_csv_bytes(df_demo),
                 "ga4_demographics_gender.csv",
                 "text/csv",
             )